@@ -98,10 +98,13 @@ import traccuracy
 from traccuracy.metrics import CTCMetrics, DivisionMetrics
 from traccuracy.matchers import IOUMatcher
 from csv import DictReader
+import pandas as pd
 
 from tqdm.auto import tqdm
 
-from typing import Iterable, Any
+from collections import defaultdict
+from itertools import chain
+from typing import Sequence, Any
 
 # %% [markdown]
 # ## Load the dataset and inspect it in napari
@@ -111,11 +114,13 @@ from typing import Iterable, Any
 
 # %% [markdown]
 # Here we load the raw image data, segmentation, and probabilities from the zarr, and view them in napari.
+#
+# The raw data is only needed for visualization, so we keep it as a lazy zarr array: napari reads the frames it displays from disk, and the full movie is never loaded into memory. The segmentation and probabilities are loaded with `[:]`, because we index into them many times below.
 
 # %%
 data_path = "./data/breast_cancer_fluo.zarr"
 data_root = zarr.open(data_path, 'r')
-image_data = data_root["raw"][:]
+image_data = data_root["raw"]
 segmentation = data_root["seg"][:]
 probabilities = data_root["probs"][:]
 
@@ -176,20 +181,27 @@ gt_tracks = read_gt_tracks()
 # %% tags=["solution"]
 def read_gt_tracks():
     gt_tracks = nx.DiGraph()
-    with open("data/breast_cancer_fluo_gt_tracks.csv") as f:
-        reader = DictReader(f)
-        for row in reader:
-            _id = int(row["id"])
-            attrs = {
-                "x": float(row["x"]),
-                "y": float(row["y"]),
-                "t": int(row["time"]),
-            }
-            parent_id = int(row["parent_id"])
-            gt_tracks.add_node(_id, **attrs)
-            if parent_id != -1:
-                gt_tracks.add_edge(parent_id, _id)
+    tracks_df = pd.read_csv(
+        "data/breast_cancer_fluo_gt_tracks.csv",
+        dtype={"id": int, "time": int, "x": float, "y": float, "parent_id": int},
+    )
+    # .tolist() converts the numpy values to python ints and floats
+    node_ids = tracks_df["id"].tolist()
+    attrs = (
+        {"x": x, "y": y, "t": t}
+        for x, y, t in zip(
+            tracks_df["x"].tolist(), tracks_df["y"].tolist(), tracks_df["time"].tolist()
+        )
+    )
+    gt_tracks.add_nodes_from(zip(node_ids, attrs))
 
+    has_parent = tracks_df["parent_id"] != -1
+    gt_tracks.add_edges_from(
+        zip(
+            tracks_df["parent_id"][has_parent].tolist(),
+            tracks_df["id"][has_parent].tolist(),
+        )
+    )
     return gt_tracks
 
 gt_tracks = read_gt_tracks()
@@ -250,7 +262,7 @@ widget.view_controller.update_napari_layers(ground_truth_run, time_attr="t", pos
 # %% [markdown]
 # <div class="alert alert-block alert-info"><h3>Task 2: Extract candidate nodes from the predicted segmentations</h3>
 # First we need to turn each segmentation into a node in a `networkx.DiGraph`.
-# Use <a href=https://scikit-image.org/docs/stable/api/skimage.measure.html#skimage.measure.regionprops>skimage.measure.regionprops</a> to extract properties from each segmentation, and create a candidate graph with nodes only.
+# Use <a href=https://scikit-image.org/docs/stable/api/skimage.measure.html#skimage.measure.regionprops_table>skimage.measure.regionprops_table</a> to extract properties from each segmentation, and create a candidate graph with nodes only. It returns a dictionary of numpy arrays with one entry per region, which is much faster than creating one <code>regionprops</code> object per region. Remember to cast the numpy values to python integers or floats when you store them in the graph.
 #
 #
 # Here are the requirements for the output graph:
@@ -279,8 +291,8 @@ def nodes_from_segmentation(segmentation: np.ndarray) -> nx.DiGraph:
     print("Extracting nodes from segmentation")
     for t in tqdm(range(len(segmentation))):
         seg_frame = segmentation[t]
-        props = skimage.measure.regionprops(seg_frame)
-        for regionprop in props:
+        props = skimage.measure.regionprops_table(seg_frame, properties=("label", "centroid"))
+        for label, centroid_0, centroid_1 in zip(props["label"], props["centroid-0"], props["centroid-1"]):
             ### YOUR CODE HERE ###
 
     return cand_graph
@@ -289,6 +301,32 @@ cand_graph = nodes_from_segmentation(segmentation)
 
 
 # %% tags=["solution"]
+def _frame_centroids(
+    seg_frame: np.ndarray, rows: np.ndarray, cols: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the centroids of all labels in one segmentation frame.
+
+    All centroids are computed at once from the pixel count and summed
+    coordinates per label, instead of one regionprop object per label.
+
+    Args:
+        seg_frame (np.ndarray): A numpy array with integer labels and dimensions
+            (y, x).
+        rows (np.ndarray): The flattened float64 row index of every pixel in the frame.
+        cols (np.ndarray): The flattened float64 column index of every pixel in the frame.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The labels present in the frame, and their
+            centroids as an array with shape (n_labels, 2).
+    """
+    flat_labels = seg_frame.ravel()
+    counts = np.bincount(flat_labels)
+    sum_x = np.bincount(flat_labels, weights=rows)
+    sum_y = np.bincount(flat_labels, weights=cols)
+    labels = np.nonzero(counts[1:])[0] + 1
+    centroids = np.stack([sum_x[labels], sum_y[labels]], axis=1) / counts[labels, None]
+    return labels, centroids
+
 def nodes_from_segmentation(segmentation: np.ndarray) -> nx.DiGraph:
     """Extract candidate nodes from a segmentation.
 
@@ -301,21 +339,22 @@ def nodes_from_segmentation(segmentation: np.ndarray) -> nx.DiGraph:
     """
     cand_graph = nx.DiGraph()
     print("Extracting nodes from segmentation")
+    num_labels = 0
+    # all frames have the same shape, so the pixel coordinates are created once. They
+    # are float64 because np.bincount would convert integer weights to float64 anyway.
+    rows, cols = np.indices(segmentation.shape[1:], dtype=np.float64).reshape(2, -1)
     for t in tqdm(range(len(segmentation))):
-        seg_frame = segmentation[t]
-        props = skimage.measure.regionprops(seg_frame)
-        for regionprop in props:
-            node_id = regionprop.label
-            x = float(regionprop.centroid[0])
-            y = float(regionprop.centroid[1])
-            attrs = {
-                "t": t,
-                "x": x,
-                "y": y,
-                "score": float(probabilities[t, int(x // 2), int(y // 2)]),
-            }
-            assert node_id not in cand_graph.nodes
-            cand_graph.add_node(node_id, **attrs)
+        node_ids, centroids = _frame_centroids(segmentation[t], rows, cols)
+        node_ids = tuple(node_ids.tolist())
+        xs, ys = centroids[:, 0], centroids[:, 1]
+        scores = probabilities[t, (xs // 2).astype(int), (ys // 2).astype(int)]
+        num_labels += len(node_ids)
+        cand_graph.add_nodes_from(
+            (node_id, {"t": t, "x": float(x), "y": float(y), "score": float(score)})
+            for node_id, x, y, score in zip(node_ids, xs, ys, scores)
+        )
+    # a label reused in another frame would have been merged into one node
+    assert cand_graph.number_of_nodes() == num_labels, "Segmentation labels are not unique across frames"
     return cand_graph
 
 cand_graph = nodes_from_segmentation(segmentation)
@@ -362,24 +401,93 @@ def _compute_node_frame_dict(cand_graph: nx.DiGraph) -> dict[int, list[Any]]:
     Returns:
         dict[int, list[Any]]: A mapping from time frames to lists of node ids.
     """
-    node_frame_dict: dict[int, list[Any]] = {}
-    for node, data in cand_graph.nodes(data=True):
-        t = data["t"]
-        if t not in node_frame_dict:
-            node_frame_dict[t] = []
+    node_frame_dict: dict[int, list[Any]] = defaultdict(list)
+    for node, t in cand_graph.nodes(data="t"):
         node_frame_dict[t].append(node)
     return node_frame_dict
 
-def create_kdtree(cand_graph: nx.DiGraph, node_ids: Iterable[Any]) -> scipy.spatial.KDTree:
-    positions = [[cand_graph.nodes[node]["x"], cand_graph.nodes[node]["y"]] for node in node_ids]
-    return scipy.spatial.KDTree(positions)
+def _get_node_positions(cand_graph: nx.DiGraph, node_ids: Sequence[Any]) -> np.ndarray:
+    """Read the positions of the given nodes from the candidate graph.
+
+    Args:
+        cand_graph (nx.DiGraph): A networkx graph with "x" and "y" node attributes
+        node_ids (Sequence[Any]): The nodes to read the positions of.
+
+    Returns:
+        np.ndarray: The (x, y) node positions as a float64 array with shape (n, 2).
+    """
+    # let np.fromiter fill the array without building a list of positions first.
+    # Contiguous float64 is what cKDTree stores internally, so it keeps this
+    # array as its .data without copying it.
+    node_data = cand_graph.nodes
+    return np.fromiter(
+        (
+            value
+            for data in map(node_data.__getitem__, node_ids)
+            for value in (data["x"], data["y"])
+        ),
+        dtype=np.float64,
+        count=2 * len(node_ids),
+    ).reshape(-1, 2)
+
+def _compute_frame_positions(
+    cand_graph: nx.DiGraph,
+) -> dict[int, tuple[Sequence[Any], np.ndarray]]:
+    """Compute dictionary from time frames to node ids and node positions for
+    candidate graph.
+
+    Args:
+        cand_graph (nx.DiGraph): A networkx graph with "t", "x" and "y" node attributes
+
+    Returns:
+        dict[int, tuple[Sequence[Any], np.ndarray]]: A mapping from time frames to
+            the node ids in that frame and their positions with shape (n, 2).
+    """
+    node_frame_dict = _compute_node_frame_dict(cand_graph)
+    return {
+        t: (tuple(node_ids), _get_node_positions(cand_graph, node_ids))
+        for t, node_ids in node_frame_dict.items()
+    }
+
+def _match_frame_pair(
+    prev_positions: np.ndarray,
+    next_positions: np.ndarray,
+    max_edge_distance: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find all pairs of positions in two adjacent frames that are closer than
+    max_edge_distance.
+
+    Args:
+        prev_positions (np.ndarray): Node positions in the earlier frame, shape (n, 2).
+        next_positions (np.ndarray): Node positions in the later frame, shape (m, 2).
+        max_edge_distance (float): Maximum distance between matched positions.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: For each matched pair, the index
+            into prev_positions, the index into next_positions, and the distance.
+    """
+    next_kdtree = scipy.spatial.cKDTree(next_positions)
+    matched_indices = next_kdtree.query_ball_point(prev_positions, r=max_edge_distance)
+
+    # flatten the matches into index arrays, so the edge distances can be
+    # computed for all edges between the two frames at once
+    prev_indices = np.repeat(
+        np.arange(len(matched_indices)), [len(indices) for indices in matched_indices]
+    )
+    next_indices = np.fromiter(
+        chain.from_iterable(matched_indices), dtype=np.intp, count=len(prev_indices)
+    )
+    offsets = next_positions[next_indices] - prev_positions[prev_indices]
+    distances = np.hypot(offsets[:, 0], offsets[:, 1])
+    return prev_indices, next_indices, distances
 
 def add_cand_edges(
     cand_graph: nx.DiGraph,
     max_edge_distance: float,
 ) -> None:
     """Add candidate edges to a candidate graph by connecting all nodes in adjacent
-    frames that are closer than max_edge_distance. Also adds attributes to the edges.
+    frames that are closer than max_edge_distance. Also adds attributes to the edges:
+    "distance" holds the Euclidean distance between the edge endpoints.
 
     Args:
         cand_graph (nx.DiGraph): Candidate graph with only nodes populated. Will
@@ -387,31 +495,23 @@ def add_cand_edges(
         max_edge_distance (float): Maximum distance that objects can travel between
             frames. All nodes within this distance in adjacent frames will by connected
             with a candidate edge.
-        node_frame_dict (dict[int, list[Any]] | None, optional): A mapping from frames
-            to node ids. If not provided, it will be computed from cand_graph. Defaults
-            to None.
     """
     print("Extracting candidate edges")
-    node_frame_dict = _compute_node_frame_dict(cand_graph)
+    frame_positions = _compute_frame_positions(cand_graph)
+    frames = [frame for frame in sorted(frame_positions.keys()) if frame + 1 in frame_positions]
 
-    frames = sorted(node_frame_dict.keys())
-    prev_node_ids = node_frame_dict[frames[0]]
-    prev_kdtree = create_kdtree(cand_graph, prev_node_ids)
     for frame in tqdm(frames):
-        if frame + 1 not in node_frame_dict:
-            continue
-        next_node_ids = node_frame_dict[frame + 1]
-        next_kdtree = create_kdtree(cand_graph, next_node_ids)
-
-        matched_indices = prev_kdtree.query_ball_tree(next_kdtree, max_edge_distance)
-
-        for prev_node_id, next_node_indices in zip(prev_node_ids, matched_indices):
-            for next_node_index in next_node_indices:
-                next_node_id = next_node_ids[next_node_index]
-                cand_graph.add_edge(prev_node_id, next_node_id)
-
-        prev_node_ids = next_node_ids
-        prev_kdtree = next_kdtree
+        prev_node_ids, prev_positions = frame_positions[frame]
+        next_node_ids, next_positions = frame_positions[frame + 1]
+        prev_indices, next_indices, distances = _match_frame_pair(
+            prev_positions, next_positions, max_edge_distance
+        )
+        cand_graph.add_edges_from(
+            (prev_node_ids[prev_index], next_node_ids[next_index], {"distance": distance})
+            for prev_index, next_index, distance in zip(
+                prev_indices.tolist(), next_indices.tolist(), distances.tolist()
+            )
+        )
 
 add_cand_edges(cand_graph, max_edge_distance=50)
 
@@ -450,46 +550,43 @@ print(f"Our ground truth track graph has {gt_tracks.number_of_nodes()} nodes and
 #
 # Here are some key similarities and differences between the quickstart and our task:
 # <ul>
-#     <li>We do not have scores on our edges. However, we can use the edge distance as a cost, so that longer edges are more costly than shorter edges. Instead of using the <code>EdgeSelection</code> cost, we can use the <a href=https://funkelab.github.io/motile/api.html#edgedistance><code>EdgeDistance</code></a> cost with <code>position_attribute="pos"</code>. You will want a positive weight, since higher distances should be more costly, unlike in the example when higher scores were good and so we inverted them with a negative weight.</li>
-#     <li>Because distance is always positive, and you want a positive weight, you will want to include a negative constant on the <code>EdgeDistance</code> cost. If there are no negative selection costs, the ILP will always select nothing, because the cost of selecting nothing is zero.</li>
+#     <li>We do not have scores on our edges. However, we can use the edge distance as a cost, so that longer edges are more costly than shorter edges. <code>add_cand_edges</code> already stored the Euclidean distance between the endpoints of each candidate edge in the <code>"distance"</code> edge attribute, so we can use the <code>EdgeSelection</code> cost with <code>attribute="distance"</code>. (Motile's <a href=https://funkelab.github.io/motile/api.html#edgedistance><code>EdgeDistance</code></a> cost with <code>position_attribute=("x", "y")</code> computes the same value from the node positions.) You will want a positive weight, since higher distances should be more costly, unlike in the example when higher scores were good and so we inverted them with a negative weight.</li>
+#     <li>Because distance is always positive, and you want a positive weight, you will want to include a negative constant on the edge distance cost. If there are no negative selection costs, the ILP will always select nothing, because the cost of selecting nothing is zero.</li>
 #     <li>We want to allow divisions. So, we should pass in 2 to our <code>MaxChildren</code> constraint. The <code>MaxParents</code> constraint should have 1, the same as the quickstart, because neither task allows merging.</li>
 #     <li>You should include an <code>Appear</code> cost and a <code>NodeSelection</code> cost similar to the one in the quickstart.</li>
 # </ul>
 #
-# Once you have set up the basic motile optimization task in the function below, you will probably need to adjust the weight and constant values on your costs until you get a solution that looks reasonable.
+# Once you have set up the basic motile optimization task in the `get_basic_solver` function below, you will probably need to adjust the weight and constant values on your costs until you get a solution that looks reasonable.
 #
 # </p>
 # </div>
 #
 
 # %% tags=["task"]
-def solve_basic_optimization(cand_graph):
-    """Set up and solve the network flow problem.
+def get_basic_solver(cand_graph):
+    """Set up the network flow problem.
 
     Args:
-        graph (nx.DiGraph): The candidate graph.
+        cand_graph (nx.DiGraph): The candidate graph.
 
     Returns:
-        nx.DiGraph: The networkx digraph with the selected solution tracks
+        motile.Solver: The solver with all costs and constraints added
     """
     cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
     ### YOUR CODE HERE ###
-    solver.solve(timeout=120)
-    solution_graph = graph_to_nx(solver.get_selected_subgraph())
-
-    return solution_graph
+    return solver
 
 
 # %% tags=["solution"]
-def solve_basic_optimization(cand_graph):
-    """Set up and solve the network flow problem.
+def get_basic_solver(cand_graph):
+    """Set up the network flow problem.
 
     Args:
-        graph (nx.DiGraph): The candidate graph.
+        cand_graph (nx.DiGraph): The candidate graph.
 
     Returns:
-        nx.DiGraph: The networkx digraph with the selected solution tracks
+        motile.Solver: The solver with all costs and constraints added
     """
     cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
@@ -497,14 +594,33 @@ def solve_basic_optimization(cand_graph):
         motile.costs.NodeSelection(weight=-1.0, attribute="score")
     )
     solver.add_cost(
-        motile.costs.EdgeDistance(weight=1, constant=-20, position_attribute=("x", "y"))
+        motile.costs.EdgeSelection(weight=1, constant=-20, attribute="distance")
     )
     solver.add_cost(motile.costs.Appear(constant=2.0))
     solver.add_cost(motile.costs.Split(constant=1.0))
 
     solver.add_constraint(motile.constraints.MaxParents(1))
     solver.add_constraint(motile.constraints.MaxChildren(2))
+    return solver
 
+
+# %% [markdown]
+# The solving itself is the same for every solver, so we provide it for you.
+
+# %%
+def solve_basic_optimization(solver):
+    """Solve the network flow problem.
+
+    The same solver can be solved again after changing its weights. Motile then
+    only recomputes the costs from the features it already extracted, and does not
+    set up the track graph, variables and constraints again.
+
+    Args:
+        solver (motile.Solver): The solver with all costs and constraints added.
+
+    Returns:
+        nx.DiGraph: The networkx digraph with the selected solution tracks
+    """
     solver.solve(timeout=120)
     solution_graph = graph_to_nx(solver.get_selected_subgraph())
     return solution_graph
@@ -532,7 +648,8 @@ def print_graph_stats(graph, name):
 
 # %%
 # run this cell to actually run the solving and get a solution
-solution_graph = solve_basic_optimization(cand_graph)
+basic_solver = get_basic_solver(cand_graph)
+solution_graph = solve_basic_optimization(basic_solver)
 
 # then print some statistics about the solution compared to the ground truth
 print_graph_stats(solution_graph, "solution")
@@ -541,6 +658,13 @@ print_graph_stats(gt_tracks, "gt tracks")
 
 # %% [markdown]
 # If you haven't selected any nodes or edges in your solution, try adjusting your weight and/or constant values. Make sure you have some negative costs or selecting nothing will always be the best solution!
+#
+# If you only want to try different weights and constants for the costs you already added, you don't need to build a new solver. `print(basic_solver.weights)` lists the names of all weights, which you can then change and solve again, for example:
+# ```
+# basic_solver.weights[("Appear", "constant")] = 5.0
+# solution_graph = solve_basic_optimization(basic_solver)
+# ```
+# This is faster than calling `get_basic_solver` again, because the costs are recomputed from features that motile already extracted from the candidate graph.
 
 # %% [markdown]
 # <div class="alert alert-block alert-warning"><h3>Question 1: Interpret your results based on statistics</h3>
@@ -582,14 +706,14 @@ def relabel_segmentation(
     """
     assign_tracklet_ids(solution_nx_graph)
     tracked_masks = np.zeros_like(segmentation)
-    for node, data in solution_nx_graph.nodes(data=True):
-        time_frame = solution_nx_graph.nodes[node]["t"]
-        previous_seg_id = node
-        track_id = solution_nx_graph.nodes[node]["tracklet_id"]
-        previous_seg_mask = (
-            segmentation[time_frame] == previous_seg_id
-        )
-        tracked_masks[time_frame][previous_seg_mask] = track_id
+    node_frame_dict = _compute_node_frame_dict(solution_nx_graph)
+    for time_frame, nodes in node_frame_dict.items():
+        seg_frame = segmentation[time_frame]
+        # lookup table from segmentation id to track id, so each frame is
+        # relabeled in a single pass. Unselected ids map to 0 (background).
+        track_id_lut = np.zeros(seg_frame.max() + 1, dtype=tracked_masks.dtype)
+        track_id_lut[nodes] = [solution_nx_graph.nodes[node]["tracklet_id"] for node in nodes]
+        tracked_masks[time_frame] = track_id_lut[seg_frame]
     return tracked_masks
 
 solution_seg = relabel_segmentation(solution_graph, segmentation)
@@ -598,7 +722,7 @@ solution_seg = relabel_segmentation(solution_graph, segmentation)
 basic_run = MotileRun(
     run_name="basic_solution",
     tracks=solution_graph,
-    output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+    output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
 )
 
 widget.view_controller.update_napari_layers(basic_run, time_attr="t", pos_attr=("x", "y"))
@@ -628,24 +752,36 @@ widget.view_controller.update_napari_layers(basic_run, time_attr="t", pos_attr=(
 # The metrics we want to compute require a ground truth segmentation. Since we do not have a ground truth segmentation, we can make one by drawing a circle around each ground truth detection. While not perfect, it will be good enough to match ground truth to predicted detections in order to compute metrics.
 
 # %%
-from skimage.draw import disk
 def make_gt_detections(data_shape, gt_tracks, radius):
     segmentation = np.zeros(data_shape, dtype="uint32")
     frame_shape = data_shape[1:]
-    # make frame with one cell in center with label 1
-    for node, data in gt_tracks.nodes(data=True):
-        pos = (data["x"], data["y"])
-        time = data["t"]
-        gt_tracks.nodes[node]["label"] = node
-        rr, cc = disk(center=pos, radius=radius, shape=frame_shape)
-        segmentation[time][rr, cc] = node
+    # pixel offsets covering the bounding box of a disk, from its upper left corner
+    box_offsets = np.arange(2 * int(np.ceil(radius)) + 2)
+    for time, node_ids in _compute_node_frame_dict(gt_tracks).items():
+        centers = _get_node_positions(gt_tracks, node_ids)
+        # draw all disks of the frame at once, using the same pixel test as
+        # skimage.draw.disk: (dx / radius)**2 + (dy / radius)**2 < 1
+        upper_left = np.maximum(np.ceil(centers - radius).astype(int), 0)
+        shifted_centers = centers - upper_left
+        dist_x = ((box_offsets - shifted_centers[:, 0:1]) / radius) ** 2
+        dist_y = ((box_offsets - shifted_centers[:, 1:2]) / radius) ** 2
+        xs = upper_left[:, 0:1] + box_offsets
+        ys = upper_left[:, 1:2] + box_offsets
+        inside = (
+            (dist_x[:, :, None] + dist_y[:, None, :] < 1)
+            & (xs < frame_shape[0])[:, :, None]
+            & (ys < frame_shape[1])[:, None, :]
+        )
+        node_index, x_index, y_index = np.nonzero(inside)
+        segmentation[time, xs[node_index, x_index], ys[node_index, y_index]] = (
+            np.asarray(node_ids)[node_index]
+        )
+    nx.set_node_attributes(gt_tracks, {node: node for node in gt_tracks.nodes}, "label")
     return segmentation
 
 gt_dets = make_gt_detections(data_root["raw"].shape, gt_tracks, 10)
 
 # %%
-import pandas as pd
-
 def get_metrics(gt_graph, labels, run, results_df):
     """Calculate metrics for linked tracks by comparing to ground truth.
 
@@ -740,7 +876,7 @@ def run_pipeline(cand_graph, run_name, results_df):
     run = MotileRun(
         run_name=run_name,
         tracks=solution_graph,
-        output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+        output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
     )
     widget.view_controller.update_napari_layers(run, time_attr="t", pos_attr=("x", "y"))
     results_df = get_metrics(gt_tracks, gt_dets, run, results_df)
@@ -767,7 +903,7 @@ def adapt_basic_optimization(cand_graph):
         motile.costs.NodeSelection(weight=-5.0, constant=2.5, attribute="score")
     )
     solver.add_cost(
-        motile.costs.EdgeDistance(weight=1, constant=-20, position_attribute=("x", "y"))
+        motile.costs.EdgeSelection(weight=1, constant=-20, attribute="distance")
     )
     solver.add_cost(motile.costs.Appear(constant=20.0))
     solver.add_cost(motile.costs.Split(constant=15.0))
@@ -785,7 +921,7 @@ def run_pipeline(cand_graph, run_name, results_df):
     run = MotileRun(
         run_name=run_name,
         tracks=solution_graph,
-        output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+        output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
     )
     widget.view_controller.update_napari_layers(run, time_attr="t", pos_attr=("x", "y"))
     results_df = get_metrics(gt_tracks, gt_dets, run, results_df)
@@ -808,7 +944,7 @@ results_df
 # %% [markdown]
 # ## Task 4 - Incorporating Known Direction of Motion
 #
-# So far, we have been using motile's EdgeDistance as an edge selection cost, which penalizes longer edges by computing the Euclidean distance between the endpoints. However, in our dataset we see a trend of upward motion in the cells, and the false detections at the top are not moving. If we penalize movement based on what we expect, rather than Euclidean distance, we can select more correct cells and penalize the non-moving artefacts at the same time.
+# So far, we have been using the "distance" attribute as an edge selection cost, which penalizes longer edges based on the Euclidean distance between the endpoints. However, in our dataset we see a trend of upward motion in the cells, and the false detections at the top are not moving. If we penalize movement based on what we expect, rather than Euclidean distance, we can select more correct cells and penalize the non-moving artefacts at the same time.
 #
 #
 
@@ -829,41 +965,50 @@ def add_drift_dist_attr(cand_graph, drift):
         cand_graph.edges[edge]["drift_dist"] = drift_dist
 
 add_drift_dist_attr(cand_graph, drift)
+# build the motile track graph once, now that all candidate attributes are set,
+# and share it between the solvers below
+cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
 
 # %% tags=["solution"]
 drift = np.array([-10, 0])
 
 def add_drift_dist_attr(cand_graph, drift):
-    for edge in cand_graph.edges():
-        source, target = edge
-        source_data = cand_graph.nodes[source]
-        source_pos = np.array([source_data["x"], source_data["y"]])
-        target_data = cand_graph.nodes[target]
-        target_pos = np.array([target_data["x"], target_data["y"]])
-        expected_target_pos = source_pos + drift
-        drift_dist = np.linalg.norm(expected_target_pos - target_pos)
-        cand_graph.edges[edge]["drift_dist"] = drift_dist
+    nodes = list(cand_graph.nodes())
+    node_index = {node: i for i, node in enumerate(nodes)}
+    positions = _get_node_positions(cand_graph, nodes)
+    edges = list(cand_graph.edges())
+    source_index = np.fromiter((node_index[source] for source, _ in edges), dtype=np.intp, count=len(edges))
+    target_index = np.fromiter((node_index[target] for _, target in edges), dtype=np.intp, count=len(edges))
+    # distance between the expected and the actual target position, for all edges at once
+    xs, ys = positions.T
+    drift_dists = np.hypot(
+        xs[target_index] - xs[source_index] - drift[0],
+        ys[target_index] - ys[source_index] - drift[1],
+    )
+    nx.set_edge_attributes(cand_graph, dict(zip(edges, drift_dists.tolist())), "drift_dist")
 
 add_drift_dist_attr(cand_graph, drift)
+# build the motile track graph once, now that all candidate attributes are set,
+# and share it between the solvers below
+cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
 
 
 # %% [markdown]
 # <div class="alert alert-block alert-info"><h3>Task 4b: Add a drift distance attribute</h3>
-# <p> Now, we set up yet another solving pipeline. This time, we will replace our EdgeDistance
-# cost with an EdgeSelection cost using our new "drift_dist" attribute. The weight should be positive, since a higher distance from the expected drift should cost more, similar to our prior EdgeDistance cost. Also similarly, we need a negative constant to make sure that the overall cost of selecting tracks is negative.</p>
+# <p> Now, we set up yet another solving pipeline. This time, we will replace our "distance"
+# cost with an EdgeSelection cost using our new "drift_dist" attribute. The weight should be positive, since a higher distance from the expected drift should cost more, similar to our prior distance cost. Also similarly, we need a negative constant to make sure that the overall cost of selecting tracks is negative.</p>
 # </div>
 
 # %% tags=["task"]
-def solve_drift_optimization(cand_graph):
+def solve_drift_optimization(cand_trackgraph):
     """Set up and solve the network flow problem.
 
     Args:
-        cand_graph (nx.DiGraph): The candidate graph.
+        cand_trackgraph (motile.TrackGraph): The candidate graph.
 
     Returns:
         nx.DiGraph: The networkx digraph with the selected solution tracks
     """
-    cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
 
     ### YOUR CODE HERE ###
@@ -874,35 +1019,34 @@ def solve_drift_optimization(cand_graph):
     return solution_graph
 
 
-def run_pipeline(cand_graph, run_name, results_df):
-    solution_graph = solve_drift_optimization(cand_graph)
+def run_pipeline(cand_trackgraph, run_name, results_df):
+    solution_graph = solve_drift_optimization(cand_trackgraph)
     solution_seg = relabel_segmentation(solution_graph, segmentation)
     run = MotileRun(
         run_name=run_name,
         tracks=solution_graph,
-        output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+        output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
     )
     widget.view_controller.update_napari_layers(run, time_attr="t", pos_attr=("x", "y"))
     results_df = get_metrics(gt_tracks, gt_dets, run, results_df)
     return results_df
 
 # Don't forget to rename your run if you re-run this cell!
-results_df = run_pipeline(cand_graph, "drift_dist", results_df)
+results_df = run_pipeline(cand_trackgraph, "drift_dist", results_df)
 results_df
 
 
 # %% tags=["solution"]
-def solve_drift_optimization(cand_graph):
+def solve_drift_optimization(cand_trackgraph):
     """Set up and solve the network flow problem.
 
     Args:
-        cand_graph (nx.DiGraph): The candidate graph.
+        cand_trackgraph (motile.TrackGraph): The candidate graph.
 
     Returns:
         nx.DiGraph: The networkx digraph with the selected solution tracks
     """
 
-    cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
     solver.add_cost(
         motile.costs.NodeSelection(weight=-100, constant=75, attribute="score")
@@ -921,20 +1065,20 @@ def solve_drift_optimization(cand_graph):
     return solution_graph
 
 
-def run_pipeline(cand_graph, run_name, results_df):
-    solution_graph = solve_drift_optimization(cand_graph)
+def run_pipeline(cand_trackgraph, run_name, results_df):
+    solution_graph = solve_drift_optimization(cand_trackgraph)
     solution_seg = relabel_segmentation(solution_graph, segmentation)
     run = MotileRun(
         run_name=run_name,
         tracks=solution_graph,
-        output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+        output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
     )
     widget.view_controller.update_napari_layers(run, time_attr="t", pos_attr=("x", "y"))
     results_df = get_metrics(gt_tracks, gt_dets, run, results_df)
     return results_df
 
 # Don't forget to rename your run if you re-run this cell!
-results_df = run_pipeline(cand_graph, "node_const_75", results_df)
+results_df = run_pipeline(cand_trackgraph, "node_const_75", results_df)
 results_df
 
 
@@ -956,24 +1100,28 @@ results_df
 # We need some ground truth annotations on our candidate graph in order to learn the best weights. The next cell contains a function that matches our ground truth graph to our candidate graph using the predicted segmentations. The function checks for each ground truth node if it is inside one of our predicted segmentations. If it is, that candidate node is marked with attribute "gt" = True. Any unmatched candidate nodes have "gt" = False. We also annotate the edges in a similar fashion - if both endpoints of a GT edge are inside predicted segmentations, the corresponding candidate edge will have "gt" = True, while all other edges going out of that candidate node have "gt" = False.
 
 # %%
-def get_cand_id(gt_node, gt_track, cand_segmentation):
-    data = gt_track.nodes[gt_node]
-    return cand_segmentation[data["t"], int(data["x"])][int(data["y"])]
+def get_cand_ids(gt_nodes, gt_track, cand_segmentation):
+    # look up the candidate ids under all ground truth nodes with a single gather
+    times = np.fromiter(
+        (gt_track.nodes[gt_node]["t"] for gt_node in gt_nodes), dtype=np.intp, count=len(gt_nodes)
+    )
+    positions = _get_node_positions(gt_track, gt_nodes).astype(np.intp)
+    return cand_segmentation[times, positions[:, 0], positions[:, 1]]
 
 def add_gt_annotations(gt_tracks, cand_graph, segmentation):
-    for gt_node in gt_tracks.nodes():
-        cand_id = get_cand_id(gt_node, gt_tracks, segmentation)
+    gt_nodes = list(gt_tracks.nodes())
+    gt_to_cand = dict(zip(gt_nodes, get_cand_ids(gt_nodes, gt_tracks, segmentation).tolist()))
+    # successor adjacency of both graphs, looked up once instead of creating
+    # a successors iterator and an edge view per node
+    gt_succs = gt_tracks.succ
+    cand_succs = cand_graph.succ
+    for gt_node, cand_id in gt_to_cand.items():
         if cand_id != 0:
             if cand_id in cand_graph:
                 cand_graph.nodes[cand_id]["gt"] = True
-                gt_succs = gt_tracks.successors(gt_node)
-                gt_succ_matches = [get_cand_id(gt_succ, gt_tracks, segmentation) for gt_succ in gt_succs]
-                cand_succs = cand_graph.successors(cand_id)
-                for succ in cand_succs:
-                    if succ in gt_succ_matches:
-                        cand_graph.edges[(cand_id, succ)]["gt"] = True
-                    else:
-                        cand_graph.edges[(cand_id, succ)]["gt"] = False
+                gt_succ_matches = {gt_to_cand[gt_succ] for gt_succ in gt_succs[gt_node]}
+                for succ, edge_data in cand_succs[cand_id].items():
+                    edge_data["gt"] = succ in gt_succ_matches
     for node in cand_graph.nodes():
        if "gt" not in cand_graph.nodes[node]:
            cand_graph.nodes[node]["gt"] = False
@@ -995,10 +1143,15 @@ add_gt_annotations(gt_tracks, validation_graph, segmentation)
 # Here we print the number of nodes and edges that have been annotated with True and False ground truth. It is important to provide negative/False annotations, as well as positive/True annotations, or the SSVM will try and select weights to pick everything.
 
 # %%
-gt_pos_nodes = [node_id for node_id, data in validation_graph.nodes(data=True) if "gt" in data and data["gt"] is True]
-gt_neg_nodes = [node_id for node_id, data in validation_graph.nodes(data=True) if "gt" in data and data["gt"] is False]
-gt_pos_edges = [(source, target) for source, target, data in validation_graph.edges(data=True) if "gt" in data and data["gt"] is True]
-gt_neg_edges = [(source, target) for source, target, data in validation_graph.edges(data=True) if "gt" in data and data["gt"] is False]
+# sort nodes and edges by their annotation in a single pass each (None: not annotated)
+gt_node_map = {True: [], False: [], None: []}
+for node_id, gt in validation_graph.nodes(data="gt"):
+    gt_node_map[gt].append(node_id)
+gt_edge_map = {True: [], False: [], None: []}
+for source, target, gt in validation_graph.edges(data="gt"):
+    gt_edge_map[gt].append((source, target))
+gt_pos_nodes, gt_neg_nodes = gt_node_map[True], gt_node_map[False]
+gt_pos_edges, gt_neg_edges = gt_edge_map[True], gt_edge_map[False]
 
 print(f"{len(gt_pos_nodes) + len(gt_neg_nodes)} annotated: {len(gt_pos_nodes)} True, {len(gt_neg_nodes)} False")
 print(f"{len(gt_pos_edges) + len(gt_neg_edges)} annotated: {len(gt_pos_edges)} True, {len(gt_neg_edges)} False")
@@ -1010,9 +1163,8 @@ print(f"{len(gt_pos_edges) + len(gt_neg_edges)} annotated: {len(gt_pos_edges)} T
 # </div>
 
 # %% tags=["task"]
-def get_ssvm_solver(cand_graph):
+def get_ssvm_solver(cand_trackgraph):
 
-    cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
 
     ### YOUR CODE HERE ###
@@ -1020,9 +1172,8 @@ def get_ssvm_solver(cand_graph):
 
 
 # %%
-def get_ssvm_solver(cand_graph):
+def get_ssvm_solver(cand_trackgraph):
 
-    cand_trackgraph = motile.TrackGraph(cand_graph, frame_attribute="t")
     solver = motile.Solver(cand_trackgraph)
     solver.add_cost(
         motile.costs.NodeSelection(weight=-1.0, attribute='score')
@@ -1043,7 +1194,8 @@ def get_ssvm_solver(cand_graph):
 # At the end, it will print the optimal weights, and you can compare them to the weights you found by trial and error.
 
 # %%
-ssvm_solver = get_ssvm_solver(validation_graph)
+validation_trackgraph = motile.TrackGraph(validation_graph, frame_attribute="t")
+ssvm_solver = get_ssvm_solver(validation_trackgraph)
 ssvm_solver.fit_weights(gt_attribute="gt", regularizer_weight=100, max_iterations=50)
 optimal_weights = ssvm_solver.weights
 optimal_weights
@@ -1051,16 +1203,29 @@ optimal_weights
 
 # %% [markdown]
 # After we have our optimal weights, we need to solve with them on the full candidate graph.
+#
+# We set up the solver for the full candidate graph once. To try other weights (for example after fitting on another validation slice), call `get_ssvm_solution(full_solver, new_weights)` again: only the costs are recomputed, instead of rebuilding all cost and constraint features.
 
 # %%
-def get_ssvm_solution(cand_graph, solver_weights):
-    solver = get_ssvm_solver(cand_graph)
-    solver.weights = solver_weights
+def get_ssvm_solution(solver, solver_weights):
+    # motile's Weights have no public way to list the weight names, so read them from
+    # the name mapping. Copying by name keeps the fitted float64 values, which
+    # to_ndarray would round to float32, and catches solvers with different costs.
+    weight_names = solver.weights._weights_by_name.keys()
+    if weight_names != solver_weights._weights_by_name.keys():
+        raise ValueError(
+            f"Solver weights {sorted(weight_names)} do not match the given weights "
+            f"{sorted(solver_weights._weights_by_name.keys())}"
+        )
+    # update the weights in place, which marks the costs of the solver as stale
+    for name in weight_names:
+        solver.weights[name] = solver_weights[name]
     solver.solve(timeout=120)
     solution_graph = graph_to_nx(solver.get_selected_subgraph())
     return solution_graph
 
-solution_graph = get_ssvm_solution(cand_graph, optimal_weights)
+full_solver = get_ssvm_solver(cand_trackgraph)
+solution_graph = get_ssvm_solution(full_solver, optimal_weights)
 
 
 # %% [markdown]
@@ -1073,7 +1238,7 @@ solution_seg = relabel_segmentation(solution_graph, segmentation)
 ssvm_run = MotileRun(
     run_name="ssvm_solution",
     tracks=solution_graph,
-    output_segmentation=np.expand_dims(solution_seg, axis=1)  # need to add a dummy dimension to fit API
+    output_segmentation=solution_seg[:, None]  # need to add a dummy dimension to fit API
 )
 
 widget.view_controller.update_napari_layers(ssvm_run, time_attr="t", pos_attr=("x", "y"))